@@ -155,6 +155,7 @@ def get_args_parser(subparsers):
     subparsers.add_argument('--n_centroids', default=10, type=int)
     # Misc parameters
     subparsers.add_argument('--print_freq', type=int, default=10, help='The frequency of printing')
+    subparsers.add_argument('--compile', action='store_true', help='torch.compile the model forwards (torch>=2.0)')
 
     # OT trick:
     subparsers.add_argument('--OT_trick', default=1, type=int)
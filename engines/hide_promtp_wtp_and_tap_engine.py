@@ -6,6 +6,9 @@ import sys
 import os
 import datetime
 import json
+import copy
+import importlib
+from collections import defaultdict
 from typing import Iterable
 from pathlib import Path
 
@@ -15,16 +18,41 @@ import torch.distributed as dist
 import numpy as np
 
 from timm.utils import accuracy
-from timm.optim import create_optimizer
 from timm.scheduler import create_scheduler
 from torch import optim
 import utils
 import tree_e
-from torch.distributions.multivariate_normal import MultivariateNormal
-import ot
 
-global mapG
-mapG = None
+TAXONOMY_MODULES = {
+    'Split-CIFAR100': 'taxanomy.cifar100',
+    'Split-Imagenet-R': 'taxanomy.imgR',
+    'Split-CUB200': 'taxanomy.CUB',
+    '5-datasets': 'taxanomy.FiveDataset',
+}
+
+def train_step(model, criterion, input, target, task_id, prompt_id, class_bias, set_training_mode, device, args):
+    output = model(input, task_id=task_id, prompt_id=prompt_id, train=set_training_mode,
+                   prompt_momentum=args.prompt_momentum)
+    logits = output['logits']
+    # here is the trick to mask out classes of non-current tasks
+    if class_bias is not None:
+        logits = logits + class_bias
+
+    # logits, _ = torch.split(logits, [bsz, bsz], dim=0)
+    loss = criterion(logits, target)  # base criterion (CrossEntropyLoss)
+    
+    # TODO add contrastive loss
+    pre_logits = output['pre_logits']
+    # pre_logits, pre_logits2 = torch.split(pre_logits, [bsz, bsz], dim=0)
+    loss += aux_losses(pre_logits, target, device, args)
+    return loss, logits
+
+# replaced by its torch.compile'd version in evaluate_till_now with --compile
+process_MHD_fn = None
+
+# stacked class means used by orth_loss, keyed on the number of updates of cls_mean
+cls_mean_version = 0
+_proto_cache = {'version': -1, 'tensor': None}
 
 def train_one_epoch(model: torch.nn.Module, original_model: torch.nn.Module,
                     criterion, data_loader: Iterable, optimizer: torch.optim.Optimizer,
@@ -41,69 +69,59 @@ def train_one_epoch(model: torch.nn.Module, original_model: torch.nn.Module,
     metric_logger.add_meter('Loss', utils.SmoothedValue(window_size=1, fmt='{value:.4f}'))
     header = f'Train: Epoch[{epoch + 1:{int(math.log10(args.epochs)) + 1}}/{args.epochs}]'
 
-    for input, target in metric_logger.log_every(data_loader, args.print_freq, header):
+    # additive -inf biases masking out classes for the original model (all seen tasks) and for the model
+    # (current task), broadcast onto the logits instead of an out-of-place index_fill per batch
+    class_bias_seen = class_bias_cur = None
+    if args.train_mask and class_mask is not None:
+        seen_mask = sum(class_mask[:task_id + 1], [])
+        not_mask_seen = torch.tensor(np.setdiff1d(np.arange(args.nb_classes), seen_mask), dtype=torch.int64,
+                                     device=device)
+        not_mask_cur = torch.tensor(np.setdiff1d(np.arange(args.nb_classes), class_mask[task_id]),
+                                    dtype=torch.int64, device=device)
+        class_bias_seen = torch.zeros(args.nb_classes, device=device)
+        class_bias_seen[not_mask_seen] = float('-inf')
+        class_bias_cur = torch.zeros(args.nb_classes, device=device)
+        class_bias_cur[not_mask_cur] = float('-inf')
+    task_map = target_task_map_tensor(target_task_map, device)
+
+    # batches arrive on the device, copied on a side stream while the previous step runs
+    data_loader = utils.CUDAPrefetcher(data_loader, device)
+    for _iter, (input, target) in enumerate(metric_logger.log_every(data_loader, args.print_freq, header)):
         # input = torch.cat([input[0], input[1]], dim=0)
-        input = input.to(device, non_blocking=True)
-        target = target.to(device, non_blocking=True)
         bsz = len(target)
 
-        with torch.no_grad():
-            if original_model is not None:
-                output = original_model(input)
-                logits = output['logits']
-
-                if args.train_mask and class_mask is not None:
-                    mask = []
-                    for id in range(task_id + 1):
-                        mask.extend(class_mask[id])
-                    not_mask = np.setdiff1d(np.arange(args.nb_classes), mask)
-                    not_mask = torch.tensor(not_mask, dtype=torch.int64).to(device)
-                    logits = logits.index_fill(dim=1, index=not_mask, value=float('-inf'))
-                    prompt_id = torch.max(logits, dim=1)[1]
-                    # translate cls to task_id
-                    prompt_id = torch.tensor([target_task_map[v.item()] for v in prompt_id], device=device).unsqueeze(
-                        -1)
-                else:
-                    prompt_id = None
-            else:
-                raise NotImplementedError("original model is None")
-        output = model(input, task_id=task_id, prompt_id=prompt_id, train=set_training_mode,
-                       prompt_momentum=args.prompt_momentum)
-        logits = output['logits']
-        # here is the trick to mask out classes of non-current tasks
+        # the original model is only needed for the prompt ids, skip its forward when they are unused
+        if original_model is None:
+            raise NotImplementedError("original model is None")
         if args.train_mask and class_mask is not None:
-            mask = class_mask[task_id]
-            not_mask = np.setdiff1d(np.arange(args.nb_classes), mask)
-            not_mask = torch.tensor(not_mask, dtype=torch.int64).to(device)
-            logits = logits.index_fill(dim=1, index=not_mask, value=float('-inf'))
-
-        # logits, _ = torch.split(logits, [bsz, bsz], dim=0)
-        loss = criterion(logits, target)  # base criterion (CrossEntropyLoss)
-        
-        # TODO add contrastive loss
-        pre_logits = output['pre_logits']
-        # pre_logits, pre_logits2 = torch.split(pre_logits, [bsz, bsz], dim=0)
-        loss += orth_loss(pre_logits, target, device, args) # robustness trick
-        
-        # TODO add cluster loss
-        loss += cluster_loss(pre_logits, target, device, args)
+            with torch.no_grad():
+                output = original_model(input)
+                logits = output['logits'] + class_bias_seen
+                prompt_id = torch.max(logits, dim=1)[1]
+                # translate cls to task_id
+                prompt_id = task_map[prompt_id].unsqueeze(-1)
+        else:
+            prompt_id = None
+        loss, logits = train_step(model, criterion, input, target, task_id, prompt_id, class_bias_cur,
+                                  set_training_mode, device, args)
         
-        acc1, acc5 = accuracy(logits, target, topk=(1, 5))
+        acc1, acc5 = topk_accuracy(logits, target)
 
-        if not math.isfinite(loss.item()):
+        # reading the loss syncs with the device, so only check it when the stats are printed anyway
+        if _iter % args.print_freq == 0 and not math.isfinite(loss.item()):
             print("Loss is {}, stopping training".format(loss.item()))
             sys.exit(1)
 
-        optimizer.zero_grad()
+        optimizer.zero_grad(set_to_none=True)
         loss.backward()
         torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm)
         optimizer.step()
 
-        torch.cuda.synchronize()
-        metric_logger.update(Loss=loss.item())
+        # meters keep device tensors and only convert them when logging
+        metric_logger.update(Loss=loss.detach())
         metric_logger.update(Lr=optimizer.param_groups[0]["lr"])
-        metric_logger.meters['Acc@1'].update(acc1.item(), n=input.shape[0])
-        metric_logger.meters['Acc@5'].update(acc5.item(), n=input.shape[0])
+        metric_logger.meters['Acc@1'].update(acc1, n=input.shape[0])
+        metric_logger.meters['Acc@5'].update(acc5, n=input.shape[0])
 
     # gather the stats from all processes
     metric_logger.synchronize_between_processes()
@@ -111,6 +129,20 @@ def train_one_epoch(model: torch.nn.Module, original_model: torch.nn.Module,
     return {k: meter.global_avg for k, meter in metric_logger.meters.items()}
 
 
+def topk_accuracy(logits, target, k=5):
+    # top-1 / top-k accuracy (%) as device scalars, from a single topk and comparison;
+    # k is clamped to the number of classes, as in timm's accuracy
+    correct = logits.topk(min(k, logits.shape[1]), dim=1).indices.eq(target.unsqueeze(1))
+    return correct[:, 0].float().mean() * 100., correct.any(dim=1).float().mean() * 100.
+
+
+def target_task_map_tensor(target_task_map, device):
+    # dense class -> task lookup table, so the translation is a gather on the device
+    task_map = torch.full((max(target_task_map) + 1,), -1, dtype=torch.int64)
+    task_map[list(target_task_map.keys())] = torch.as_tensor(list(target_task_map.values()), dtype=torch.int64)
+    return task_map.to(device)
+
+
 @torch.no_grad()
 def evaluate(model: torch.nn.Module, original_model: torch.nn.Module, data_loader,
              device, i=-1, task_id=-1, class_mask=None, target_task_map=None, args=None, eval_trick=False):
@@ -123,27 +155,29 @@ def evaluate(model: torch.nn.Module, original_model: torch.nn.Module, data_loade
     model.eval()
     original_model.eval()
 
-    with torch.no_grad():
-        for input, target in metric_logger.log_every(data_loader, args.print_freq, header):
-            input = input.to(device, non_blocking=True)
-            target = target.to(device, non_blocking=True)
+    if args.train_mask and class_mask is not None:
+        seen_mask = sum(class_mask[:task_id + 1], [])
+        not_mask = torch.tensor(np.setdiff1d(np.arange(args.nb_classes), seen_mask), dtype=torch.int64,
+                                device=device)
+    task_map = target_task_map_tensor(target_task_map, device)
 
+    if args.task_inc and class_mask is not None:
+        # additive bias keeping only the classes of task i
+        per_class_bias = torch.full((args.nb_classes,), float('-inf'), device=device)
+        per_class_bias[torch.as_tensor(class_mask[i], device=device)] = 0.0
+
+    with torch.no_grad():
+        for input, target in metric_logger.log_every(utils.CUDAPrefetcher(data_loader, device), args.print_freq, header):
             # compute output
             with torch.no_grad():
                 if original_model is not None:
                     output = original_model(input)
                     logits = output['logits']
                     if args.train_mask and class_mask is not None:
-                        mask = []
-                        for id in range(task_id + 1):
-                            mask.extend(class_mask[id])
-                        not_mask = np.setdiff1d(np.arange(args.nb_classes), mask)
-                        not_mask = torch.tensor(not_mask, dtype=torch.int64).to(device)
                         logits = logits.index_fill(dim=1, index=not_mask, value=float('-inf'))
                     prompt_id = torch.max(logits, dim=1)[1]
                     # translate cls to task_id
-                    prompt_id = torch.tensor([target_task_map[v.item()] for v in prompt_id], device=device).unsqueeze(
-                        -1)
+                    prompt_id = task_map[prompt_id].unsqueeze(-1)
                 else:
                     raise NotImplementedError("original model is None")
 
@@ -154,20 +188,13 @@ def evaluate(model: torch.nn.Module, original_model: torch.nn.Module, data_loade
 
             if args.task_inc and class_mask is not None:
                 # adding mask to output logits
-                mask = class_mask[i]
-                mask = torch.tensor(mask, dtype=torch.int64).to(device)
-                logits_mask = torch.ones_like(logits, device=device) * float('-inf')
-                logits_mask = logits_mask.index_fill(1, mask, 0.0)
-                logits = logits + logits_mask
+                logits = logits + per_class_bias
 
         
             # For eval trick: 
             if eval_trick:
                 MHD = MHD_cls(features, device, args)
-                if mapG == None:
-                    create_number_to_sublist_map(args.G)
-
-                energy = process_MHD(MHD, logits, args)
+                energy = (process_MHD_fn or process_MHD)(MHD, logits, args)
                 logits = energy
 
             loss = criterion(logits, target)
@@ -196,6 +223,14 @@ def evaluate_till_now(model: torch.nn.Module, original_model: torch.nn.Module, d
                       device, task_id=-1, class_mask=None, target_task_map=None, acc_matrix=None, args=None, eval_trick=False):
     stat_matrix = np.zeros((4, args.num_tasks))  # 3 for Acc@1, Acc@5, Loss
 
+    # the eval-trick rescoring is a short chain of gathers and elementwise ops, fused by torch.compile;
+    # shapes only change with the last batch of a loader
+    global process_MHD_fn
+    if eval_trick and process_MHD_fn is None:
+        process_MHD_fn = process_MHD
+        if args.compile and hasattr(torch, 'compile'):
+            process_MHD_fn = torch.compile(process_MHD, dynamic=False)
+
     for i in range(task_id + 1):
         test_stats = evaluate(model=model, original_model=original_model, data_loader=data_loader[i]['val'],
                               device=device, i=i, task_id=task_id, class_mask=class_mask, target_task_map=target_task_map,
@@ -243,6 +278,7 @@ def train_and_evaluate(model: torch.nn.Module, model_without_ddp: torch.nn.Modul
     global cls_cov
     cls_mean = dict()
     cls_cov = dict()
+    cls_mean_updated()
     
     global org_cls_mean
     global org_cls_cov
@@ -255,45 +291,42 @@ def train_and_evaluate(model: torch.nn.Module, model_without_ddp: torch.nn.Modul
     old_labels = torch.empty(0).to(device)
     
     global current_llist
+    global class_group_member
     global WSDMatrix
-    WSDMatrix = torch.zeros(size=(args.nb_classes, args.nb_classes)) # computed on the original latent space
+    global WSDDone
+    global WSDGamma
+    WSDMatrix = torch.zeros(size=(args.nb_classes, args.nb_classes), device=device) # computed on the original latent space
+    WSDDone = torch.zeros(size=(args.nb_classes, args.nb_classes), dtype=torch.bool, device=device)
+    WSDGamma = torch.exp(-WSDMatrix / args.delta) # supcon weights of the class pairs, refreshed with WSDMatrix
     
     global WSDMatrix_eval
-    WSDMatrix_eval = torch.zeros(size=(args.nb_classes, args.nb_classes)) # computed on the original latent space
+    global WSDDone_eval
+    WSDMatrix_eval = torch.zeros(size=(args.nb_classes, args.nb_classes), device=device) # computed on the original latent space
+    WSDDone_eval = torch.zeros(size=(args.nb_classes, args.nb_classes), dtype=torch.bool, device=device)
     
     
-    if args.dataset == 'Split-CIFAR100':
-        if args.order == 1:
-            import taxanomy.cifar100.order1.taxanomy as taxonomy
-    elif args.dataset == 'Split-Imagenet-R':
-        if args.order == 1:
-            import taxanomy.imgR.order1.taxanomy as taxonomy
-    elif args.dataset == 'Split-CUB200':
-        if args.order == 1:
-            import taxanomy.CUB.order1.taxanomy as taxonomy
-    elif args.dataset == '5-datasets':
-        if args.order == 1:
-            import taxanomy.FiveDataset.order1.taxanomy as taxonomy
-    else:
+    if args.dataset not in TAXONOMY_MODULES:
         print('Have not been supported')   
         exit() 
-            
+    taxonomy = importlib.import_module('{}.order{}.taxanomy'.format(TAXONOMY_MODULES[args.dataset], args.order))
+
+    initial_hparams = [{k: v for k, v in param_group.items() if k != 'params'} for param_group in optimizer.param_groups]
+    initial_hparams = copy.deepcopy(initial_hparams)
+
+    # with --compile only the model forwards are compiled, the losses have data-dependent shapes
+    teacher_model, train_model = original_model, model
+    if args.compile and hasattr(torch, 'compile'):
+        teacher_model = torch.compile(original_model)
+        train_model = torch.compile(model)
+
 
     for task_id in range(args.num_tasks):
-        # Create new optimizer for each task to clear optimizer status
+        # Reset the optimizer for each task to clear optimizer status; the parameters (and so the param groups)
+        # do not change across tasks, so the optimizer object is kept and only its state and hparams are reset
         if task_id > 0 and args.reinit_optimizer:
-            if args.larger_prompt_lr:
-                # This is a simple yet effective trick that helps to learn task-specific prompt better.
-                base_params = [p for name, p in model_without_ddp.named_parameters() if
-                            'prompt' in name and p.requires_grad == True]
-                base_fc_params = [p for name, p in model_without_ddp.named_parameters() if
-                                'prompt' not in name and p.requires_grad == True]
-                base_params = {'params': base_params, 'lr': args.lr, 'weight_decay': args.weight_decay}
-                base_fc_params = {'params': base_fc_params, 'lr': args.lr * 0.1, 'weight_decay': args.weight_decay}
-                network_params = [base_params, base_fc_params]
-                optimizer = create_optimizer(args, network_params)
-            else:
-                optimizer = create_optimizer(args, model)
+            optimizer.state = defaultdict(dict)
+            for param_group, hparams in zip(optimizer.param_groups, initial_hparams):
+                param_group.update(copy.deepcopy(hparams))
             
             if args.sched != 'constant':
                 lr_scheduler, _ = create_scheduler(args, optimizer)
@@ -339,11 +372,11 @@ def train_and_evaluate(model: torch.nn.Module, model_without_ddp: torch.nn.Modul
 
                     with torch.no_grad():
                         if args.distributed:
-                            model.module.e_prompt.prompt.grad.zero_()
+                            model.module.e_prompt.prompt.grad = None
                             model.module.e_prompt.prompt[cur_idx] = model.module.e_prompt.prompt[prev_idx]
                             # optimizer.param_groups[0]['params'] = model.module.parameters()
                         else:
-                            model.e_prompt.prompt.grad.zero_()
+                            model.e_prompt.prompt.grad = None
                             model.e_prompt.prompt[cur_idx] = model.e_prompt.prompt[prev_idx]
                             # optimizer.param_groups[0]['params'] = model.parameters()
 
@@ -358,18 +391,23 @@ def train_and_evaluate(model: torch.nn.Module, model_without_ddp: torch.nn.Modul
 
                 with torch.no_grad():
                     if args.distributed:
-                        model.module.e_prompt.prompt_key.grad.zero_()
+                        model.module.e_prompt.prompt_key.grad = None
                         model.module.e_prompt.prompt_key[cur_idx] = model.module.e_prompt.prompt_key[prev_idx]
                         optimizer.param_groups[0]['params'] = model.module.parameters()
                     else:
-                        model.e_prompt.prompt_key.grad.zero_()
+                        model.e_prompt.prompt_key.grad = None
                         model.e_prompt.prompt_key[cur_idx] = model.e_prompt.prompt_key[prev_idx]
                         optimizer.param_groups[0]['params'] = model.parameters()
 
         current_taxonomy = taxonomy.T[task_id+1]
         current_llist = tree_e.leaf_group_to_llist(current_taxonomy, dataset_name=args.dataset)
+        # nb_classes x num_sets membership of the classes in the groups of the current taxonomy level;
+        # groups can overlap, a class belongs to every group that lists it
+        class_group_member = torch.zeros((args.nb_classes, len(current_llist)), dtype=torch.bool, device=device)
+        for k, label_subset in enumerate(current_llist):
+            class_group_member[torch.as_tensor(label_subset, dtype=torch.int64, device=device), k] = True
         for epoch in range(args.epochs):
-            train_stats = train_one_epoch(model=model, original_model=original_model, criterion=criterion,
+            train_stats = train_one_epoch(model=train_model, original_model=teacher_model, criterion=criterion,
                                             data_loader=data_loader[task_id]['train'], optimizer=optimizer,
                                             device=device, epoch=epoch, max_norm=args.clip_grad,
                                             set_training_mode=True, task_id=task_id, class_mask=class_mask,
@@ -423,7 +461,8 @@ def train_and_evaluate(model: torch.nn.Module, model_without_ddp: torch.nn.Modul
             if args.sched is not None and args.sched != 'constant':
                 state_dict['lr_scheduler'] = lr_scheduler.state_dict()
 
-            utils.save_on_master(state_dict, checkpoint_path)
+            # serialized in the background while the next task trains
+            utils.save_on_master_async(state_dict, checkpoint_path)
 
         log_stats = {**{f'train_{k}': v for k, v in train_stats.items()},
                      **{f'test_{k}': v for k, v in test_stats.items()},
@@ -435,55 +474,17 @@ def train_and_evaluate(model: torch.nn.Module, model_without_ddp: torch.nn.Modul
                       'a') as f:
                 f.write(json.dumps(log_stats) + '\n')
 
+    utils.wait_for_async_save()
+
 @torch.no_grad()
 def _compute_mean_org(original_model: torch.nn.Module, data_loader: Iterable, device: torch.device, task_id, class_mask=None, args=None, ):
     original_model.eval()
 
     print('Computing means......', len(class_mask), class_mask)
     for cls_id in class_mask:
-        data_loader_cls = data_loader[cls_id]['train']
-        features_per_cls = []
-        for i, (inputs, targets) in enumerate(data_loader_cls):
-            inputs = inputs.to(device, non_blocking=True)
-            features = original_model(inputs)['pre_logits']
-            # print(features.shape)
-            features_per_cls.append(features)
-        features_per_cls = torch.cat(features_per_cls, dim=0)
-        features_per_cls_list = [torch.zeros_like(features_per_cls, device=device) for _ in range(args.world_size)]
-
-        dist.barrier()
-        dist.all_gather(features_per_cls_list, features_per_cls)
-
-        if args.ca_storage_efficient_method == 'covariance':
-            features_per_cls = torch.cat(features_per_cls_list, dim=0)
-            # print(features_per_cls.shape)
-            org_cls_mean[cls_id] = features_per_cls.mean(dim=0)
-            org_cls_cov[cls_id] = torch.cov(features_per_cls.T) + (torch.eye(cls_mean[cls_id].shape[-1]) * 1e-4).to(device)
-        
-        if args.ca_storage_efficient_method == 'variance':
-            features_per_cls = torch.cat(features_per_cls_list, dim=0)
-            # print(features_per_cls.shape)
-            org_cls_mean[cls_id] = features_per_cls.mean(dim=0)
-            org_cls_cov[cls_id] = torch.diag(torch.cov(features_per_cls.T) + (torch.eye(cls_mean[cls_id].shape[-1]) * 1e-4).to(device))
-        if args.ca_storage_efficient_method == 'multi-centroid':
-            from sklearn.cluster import KMeans
-            n_clusters = args.n_centroids
-            features_per_cls = torch.cat(features_per_cls_list, dim=0).cpu().numpy()
-            kmeans = KMeans(n_clusters=n_clusters)
-            kmeans.fit(features_per_cls)
-            cluster_lables = kmeans.labels_
-            cluster_means = []
-            cluster_vars = []
-            for i in range(n_clusters):
-               cluster_data = features_per_cls[cluster_lables == i]
-               cluster_mean = torch.tensor(np.mean(cluster_data, axis=0), dtype=torch.float64).to(device)
-               cluster_var = torch.tensor(np.var(cluster_data, axis=0), dtype=torch.float64).to(device)
-               cluster_means.append(cluster_mean)
-               cluster_vars.append(cluster_var)
-            
-            org_cls_mean[cls_id] = cluster_means
-            org_cls_cov[cls_id] = cluster_vars
-            
+        org_cls_mean[cls_id], org_cls_cov[cls_id] = _class_statistics(
+            lambda inputs: original_model(inputs)['pre_logits'], data_loader[cls_id]['train'], device, args)
+
     update_WSM(args)
 
 @torch.no_grad()
@@ -492,132 +493,206 @@ def _compute_mean(model: torch.nn.Module, data_loader: Iterable, device: torch.d
     model.eval()
 
     for cls_id in class_mask:
-        data_loader_cls = data_loader[cls_id]['train']
-        features_per_cls = []
-        for i, (inputs, targets) in enumerate(data_loader_cls):
-            inputs = inputs.to(device, non_blocking=True)
-            features = model(inputs, task_id=task_id, train=True)['pre_logits']
-            features_per_cls.append(features)
-        features_per_cls = torch.cat(features_per_cls, dim=0)
-        features_per_cls_list = [torch.zeros_like(features_per_cls, device=device) for _ in range(args.world_size)]
-
-        dist.barrier()
-        dist.all_gather(features_per_cls_list, features_per_cls)
-
-        if args.ca_storage_efficient_method == 'covariance':
-            features_per_cls = torch.cat(features_per_cls_list, dim=0)
-            # print(features_per_cls.shape)
-            cls_mean[cls_id] = features_per_cls.mean(dim=0)
-            cls_cov[cls_id] = torch.cov(features_per_cls.T) + (torch.eye(cls_mean[cls_id].shape[-1]) * 1e-4).to(device)
-        
-        if args.ca_storage_efficient_method == 'variance':
-            features_per_cls = torch.cat(features_per_cls_list, dim=0)
-            # print(features_per_cls.shape)
-            cls_mean[cls_id] = features_per_cls.mean(dim=0)
-            cls_cov[cls_id] = torch.diag(torch.cov(features_per_cls.T) + (torch.eye(cls_mean[cls_id].shape[-1]) * 1e-4).to(device))
-        if args.ca_storage_efficient_method == 'multi-centroid':
-            from sklearn.cluster import KMeans
-            n_clusters = args.n_centroids
-            features_per_cls = torch.cat(features_per_cls_list, dim=0).cpu().numpy()
-            kmeans = KMeans(n_clusters=n_clusters)
-            kmeans.fit(features_per_cls)
-            cluster_lables = kmeans.labels_
-            cluster_means = []
-            cluster_vars = []
-            for i in range(n_clusters):
-               cluster_data = features_per_cls[cluster_lables == i]
-               cluster_mean = torch.tensor(np.mean(cluster_data, axis=0), dtype=torch.float64).to(device)
-               cluster_var = torch.tensor(np.var(cluster_data, axis=0), dtype=torch.float64).to(device)
-               cluster_means.append(cluster_mean)
-               cluster_vars.append(cluster_var)
-            
-            cls_mean[cls_id] = cluster_means
-            cls_cov[cls_id] = cluster_vars
-            
+        cls_mean[cls_id], cls_cov[cls_id] = _class_statistics(
+            lambda inputs: model(inputs, task_id=task_id, train=True)['pre_logits'], data_loader[cls_id]['train'],
+            device, args)
+    cls_mean_updated()
+
     update_WSM_eval(args)
-            
+
+def _gather_class_features(forward, data_loader_cls, device, args):
+    # features of one class from all ranks, written in place into preallocated buffers
+    features_per_cls = None
+    n = 0
+    for inputs, targets in data_loader_cls:
+        inputs = inputs.to(device, non_blocking=True)
+        features = forward(inputs)
+        if features_per_cls is None:
+            features_per_cls = torch.empty(len(data_loader_cls.sampler), features.shape[-1], dtype=features.dtype,
+                                           device=device)
+        features_per_cls[n:n + len(features)] = features
+        n += len(features)
+    features_per_cls = features_per_cls[:n]
+    gathered = torch.empty(args.world_size * n, features_per_cls.shape[-1], dtype=features_per_cls.dtype,
+                           device=device)
+
+    dist.all_gather_into_tensor(gathered, features_per_cls)
+    return gathered
+
+def _class_statistics(forward, data_loader_cls, device, args):
+    # (mean, cov) of one class in the layout of args.ca_storage_efficient_method
+    if args.ca_storage_efficient_method in ['covariance', 'variance']:
+        return _moment_statistics(forward, data_loader_cls, device, args)
+
+    if args.ca_storage_efficient_method == 'multi-centroid':
+        # clustering needs every sample, so the features are gathered from all ranks
+        features_per_cls = _gather_class_features(forward, data_loader_cls, device, args)
+        n_clusters = args.n_centroids
+        centroids, cluster_lables = _kmeans(features_per_cls, n_clusters)
+        # per-cluster mean / (biased) variance in one scatter, relative to the centroids for stability
+        diff = features_per_cls - centroids[cluster_lables]
+        counts = torch.bincount(cluster_lables, minlength=n_clusters).clamp_min(1).unsqueeze(1)
+        diff_mean = torch.zeros_like(centroids).index_add_(0, cluster_lables, diff) / counts
+        diff_sqr = torch.zeros_like(centroids).index_add_(0, cluster_lables, diff * diff) / counts
+        cluster_means = centroids + diff_mean
+        cluster_vars = (diff_sqr - diff_mean.pow(2)).clamp_min(0)
+        return list(cluster_means.unbind(0)), list(cluster_vars.unbind(0))
+
+    raise NotImplementedError
+
+def _moment_statistics(forward, data_loader_cls, device, args):
+    # single streaming pass: sums of the features and of their squares / outer products, reduced over
+    # ranks; features are shifted by rank 0's first batch mean to keep the fp32 sums well conditioned
+    full_cov = args.ca_storage_efficient_method == 'covariance'
+    shift = s1 = s2 = None
+    n = torch.zeros((), device=device)
+    for inputs, targets in data_loader_cls:
+        inputs = inputs.to(device, non_blocking=True)
+        features = forward(inputs)
+        if shift is None:
+            shift = features.mean(dim=0)
+            dist.broadcast(shift, src=0)
+            s1 = torch.zeros_like(shift)
+            s2 = torch.zeros(shift.shape[0], shift.shape[0], device=device) if full_cov else torch.zeros_like(shift)
+        features = features - shift
+        s1 += features.sum(dim=0)
+        s2 += features.T @ features if full_cov else features.pow(2).sum(dim=0)
+        n += features.shape[0]
+
+    dist.all_reduce(s1)
+    dist.all_reduce(s2)
+    dist.all_reduce(n)
+
+    mean = shift + s1 / n
+    # unbiased, as torch.cov
+    if full_cov:
+        cov = (s2 - torch.outer(s1, s1) / n) / (n - 1)
+        return mean, cov + torch.eye(mean.shape[-1], device=device) * 1e-4
+    return mean, (s2 - s1.pow(2) / n) / (n - 1) + 1e-4
+
+def _kmeans(x, n_clusters, n_iter=100, n_init=10):
+    # best of n_init runs by inertia, as sklearn's KMeans default that this replaces
+    best = None
+    for _ in range(n_init):
+        centroids, labels = _kmeans_single(x, n_clusters, n_iter)
+        inertia = (x - centroids[labels]).pow(2).sum()
+        if best is None or inertia < best[0]:
+            best = (inertia, centroids, labels)
+    return best[1], best[2]
+
+def _kmeans_single(x, n_clusters, n_iter):
+    # k-means++ seeding followed by Lloyd iterations, on the device of x
+    centroids = x[torch.randint(len(x), (1,), device=x.device)]
+    for _ in range(1, n_clusters):
+        d = torch.cdist(x, centroids).min(dim=1)[0].pow(2)
+        centroids = torch.cat([centroids, x[torch.multinomial(d + 1e-12, 1)]], dim=0)
+
+    for _ in range(n_iter):
+        labels = torch.cdist(x, centroids).argmin(dim=1)
+        counts = torch.bincount(labels, minlength=n_clusters).unsqueeze(1)
+        sums = torch.zeros_like(centroids).index_add_(0, labels, x)
+        new_centroids = torch.where(counts > 0, sums / counts.clamp_min(1), centroids)
+        if torch.allclose(new_centroids, centroids):
+            break
+        centroids = new_centroids
+    return centroids, torch.cdist(x, centroids).argmin(dim=1)
+
 # OT-based stuffs:
 @torch.no_grad()
 def update_WSM(args):
-    n = len(org_cls_mean)
-    class_ids = org_cls_mean.keys()
-    for i in class_ids:
-        for j in class_ids:
-            if WSDMatrix[i][j] != 0:
-                continue 
-            else:
-                # WSDMatrix[i][j] = wsd_gmm_d(org_cls_mean[i], org_cls_mean[j], org_cls_cov[i], org_cls_cov[j], args)
-                WSDMatrix[i][j] = wsd_gmm_s(org_cls_mean[i], org_cls_mean[j], org_cls_cov[i], org_cls_cov[j], args) 
-                WSDMatrix[j][i] = WSDMatrix[i][j]
-                
+    global WSDGamma
+    _update_wsd_matrix(WSDMatrix, WSDDone, org_cls_mean, org_cls_cov, args)
+    WSDGamma = torch.exp(-WSDMatrix / args.delta)
     print(WSDMatrix.max())
     return
 
 @torch.no_grad()
 def update_WSM_eval(args):
-    n = len(cls_mean)
-    class_ids = cls_mean.keys()
-    for i in class_ids:
-        for j in class_ids:
-            if WSDMatrix_eval[i][j] != 0:
-                continue 
-            else:
-                # WSDMatrix[i][j] = wsd_gmm_d(org_cls_mean[i], org_cls_mean[j], org_cls_cov[i], org_cls_cov[j], args)
-                WSDMatrix_eval[i][j] = wsd_gmm_s(cls_mean[i], cls_mean[j], cls_cov[i], cls_cov[j], args) 
-                WSDMatrix_eval[j][i] = WSDMatrix_eval[i][j]
-                
+    _update_wsd_matrix(WSDMatrix_eval, WSDDone_eval, cls_mean, cls_cov, args)
     print(WSDMatrix_eval.max())
     return
 
-def gaussian_wasserstein(mean1, cov1, mean2, cov2):
-    delta_mean = mean1 - mean2
-    cov_sqrt = torch.linalg.sqrtm(cov1 @ cov2)
-    
-    if torch.is_complex(cov_sqrt):
-        cov_sqrt = cov_sqrt.real
-    
-    distance = torch.dot(delta_mean, delta_mean)
-    distance += torch.trace(cov1 + cov2 - 2 * cov_sqrt)
-    return torch.sqrt(distance)
-
-def wsd_gmm_d(means1, means2, covs1, covs2, args):
-    total_distance = 0.0
-    for i in range(len(means1)):
-        for j in range(len(means2)):
-            distance = gaussian_wasserstein(means1[i], covs1[i], means2[j], covs2[j])
-            total_distance += distance
-    return total_distance/(len(means1)*len(means2)*1.)
-
-def wsd_gmm_s(means1, means2, covs1 ,covs2, args):
-
-    # Sample from the GMMs
-    num_sampled_pcls = args.batch_size * 5
-    samples1 = gmm_sample(means1, covs1, num_sampled_pcls)
-    samples2 = gmm_sample(means2, covs2, num_sampled_pcls)
-
-    # Compute pairwise distance matrix
-    M = ot.dist(samples1.cpu().numpy(), samples2.cpu().numpy())
-    a = np.ones((samples1.shape[0],)) / samples1.shape[0]
-    b = np.ones((samples2.shape[0],)) / samples2.shape[0]
-
-    # Compute optimal transport plan and Wasserstein distance
-    wasserstein_distance = ot.emd2(a, b, M)
-    
-    return wasserstein_distance
-
-def gmm_sample(means1, covs1, num_sampled_pcls):
-    sampled_data = []
-    for cluster in range(len(means1)):
-        mean = means1[cluster]
-        var = covs1[cluster]
-        if var.mean() == 0:
-            continue
-        m = MultivariateNormal(mean.float(), (torch.diag(var) + 1e-4 * torch.eye(mean.shape[0]).to(mean.device)).float())
-        sampled_data_single = m.sample(sample_shape=(num_sampled_pcls,))
-        sampled_data.append(sampled_data_single)
-        
-    sampled_data = torch.cat(sampled_data, dim=0).float().cuda()
-    return sampled_data
+def _update_wsd_matrix(wsd_matrix, wsd_done, means, covs, args):
+    # fill the upper triangle (diagonal included) of the class pairs not computed in earlier tasks at once
+    # and mirror it; wsd_done tracks computed pairs so that a legitimate 0 distance is not recomputed
+    class_ids = list(means.keys())
+    n = len(class_ids)
+    if n < 1:
+        return
+    device = wsd_matrix.device
+    rows, cols = torch.triu_indices(n, n, offset=0, device=device)
+    row_ids = torch.as_tensor(class_ids, dtype=torch.long, device=device)[rows]
+    col_ids = torch.as_tensor(class_ids, dtype=torch.long, device=device)[cols]
+    todo = ~wsd_done[row_ids, col_ids]
+    if not todo.any():
+        return
+    rows, cols, row_ids, col_ids = rows[todo], cols[todo], row_ids[todo], col_ids[todo]
+
+    wsd = sliced_wsd_matrix([means[c] for c in class_ids], [covs[c] for c in class_ids], args).to(device)
+    values = wsd[rows, cols].to(wsd_matrix.dtype)
+    wsd_matrix[row_ids, col_ids] = values
+    wsd_matrix[col_ids, row_ids] = values
+    wsd_done[row_ids, col_ids] = True
+    wsd_done[col_ids, row_ids] = True
+
+def _stack_gmms(means, covs, args):
+    # means: C x K x D, scale: C x K x D std (diagonal) or C x K x D x D cholesky factor ('covariance'),
+    # valid: C x K mask of the components that can be sampled
+    if args.ca_storage_efficient_method == 'multi-centroid':
+        M = torch.stack([torch.stack(m) for m in means]).float()
+        V = torch.stack([torch.stack(v) for v in covs]).float().to(M.device)
+        valid = V.mean(dim=-1) != 0
+        scale = torch.sqrt(V + 1e-4)
+    elif args.ca_storage_efficient_method == 'variance':
+        M = torch.stack(means).float().unsqueeze(1)
+        V = torch.stack(covs).float().to(M.device).unsqueeze(1)
+        valid = torch.ones(V.shape[:2], dtype=torch.bool, device=M.device)
+        scale = torch.sqrt(V.clamp_min(0))
+    elif args.ca_storage_efficient_method == 'covariance':
+        M = torch.stack(means).float().unsqueeze(1)
+        V = torch.stack(covs).float().to(M.device).unsqueeze(1)
+        valid = torch.ones(V.shape[:2], dtype=torch.bool, device=M.device)
+        scale = torch.linalg.cholesky(V)
+    else:
+        raise NotImplementedError
+    return M, scale, valid
+
+def sliced_wsd_matrix(means, covs, args, n_projections=50, chunk_size=16):
+    # Pairwise sliced Wasserstein distances between class GMMs: every class is sampled once and projected
+    # on shared random directions, so the sorted 1D transport of all pairs reduces to one Gram matrix.
+    # Scaled by D to keep the magnitude of a squared-euclidean transport cost.
+    M, scale, valid = _stack_gmms(means, covs, args)
+    C, K, D = M.shape
+    device = M.device
+    num_sampled = args.batch_size * 5 * K
+
+    theta = torch.randn(D, n_projections, device=device)
+    theta = theta / theta.norm(dim=0, keepdim=True)
+
+    def sorted_projections(idx):
+        # pick a mixture component per sample, uniformly among the usable ones
+        comp = torch.multinomial(valid[idx].float(), num_sampled, replacement=True)
+        rows = torch.arange(len(idx), device=device).unsqueeze(1)
+        eps = torch.randn(len(idx), num_sampled, D, device=device)
+        if scale.dim() == 3:
+            samples = M[idx][rows, comp] + eps * scale[idx][rows, comp]
+        else:
+            # full covariance is a single component per class
+            samples = M[idx] + torch.einsum('cij,cnj->cni', scale[idx][:, 0], eps)
+        return torch.sort(samples @ theta, dim=1)[0].reshape(len(idx), -1)
+
+    proj = torch.empty(C, num_sampled * n_projections, device=device)
+    self_wsd = torch.empty(C, device=device)
+    for idx in torch.arange(C, device=device).split(chunk_size):
+        proj[idx] = sorted_projections(idx)
+        # the diagonal compares a class with a second, independent draw of itself, as the per-pair
+        # sampling did; it is nonzero and weights the same-class pairs through Gamma
+        self_wsd[idx] = (proj[idx] - sorted_projections(idx)).pow(2).mean(dim=1)
+
+    sq = proj.pow(2).mean(dim=1)
+    wsd = sq.unsqueeze(1) + sq.unsqueeze(0) - 2 * (proj @ proj.t()) / proj.shape[1]
+    wsd.diagonal().copy_(self_wsd)
+    return wsd.clamp_min(0) * D
 
 def train_task_adaptive_prediction(model: torch.nn.Module, args, device, class_mask=None, task_id=-1):
     model.train()
@@ -626,203 +701,176 @@ def train_task_adaptive_prediction(model: torch.nn.Module, args, device, class_m
     param_list = [p for n, p in model.named_parameters() if p.requires_grad and 'prompt' not in n]
     network_params = [{'params': param_list, 'lr': args.ca_lr, 'weight_decay': args.weight_decay}]
     if 'mae' in args.model or 'beit' in args.model:
-        optimizer = optim.AdamW(network_params, lr=args.ca_lr / 10, weight_decay=args.weight_decay)
+        optimizer = optim.AdamW(network_params, lr=args.ca_lr / 10, weight_decay=args.weight_decay, foreach=True)
     else:
-        optimizer = optim.SGD(network_params, lr=args.ca_lr, momentum=0.9, weight_decay=5e-4)
+        optimizer = optim.SGD(network_params, lr=args.ca_lr, momentum=0.9, weight_decay=5e-4, foreach=True)
+    # the head is small and memory bound, run it in bf16 where the device supports it
+    use_bf16 = torch.cuda.is_available() and torch.cuda.is_bf16_supported()
 
     scheduler = optim.lr_scheduler.CosineAnnealingLR(optimizer=optimizer, T_max=run_epochs)
     criterion = torch.nn.CrossEntropyLoss().to(device)
 
     for i in range(task_id):
         crct_num += len(class_mask[i])
-        
-    latest_data = []
-    latest_labels = []
+
+    # stack the statistics of all seen classes once, every usable (class, component) pair is one gaussian
+    num_sampled_pcls = args.batch_size * 5
+    seen_classes = sum(class_mask[:task_id + 1], [])
+    with torch.no_grad():
+        means, scale, valid = _stack_gmms([cls_mean[c_id] for c_id in seen_classes],
+                                          [cls_cov[c_id] for c_id in seen_classes], args)
+        comp = valid.nonzero(as_tuple=True)
+        means, scale = means.to(device)[comp], scale.to(device)[comp]
+        labels = torch.as_tensor(seen_classes, dtype=torch.int64, device=device)[comp[0].to(device)]
+
+    # -inf bias on the classes of unseen tasks, constant for the whole task
+    class_bias_seen = None
+    if args.train_mask and class_mask is not None:
+        not_mask = torch.as_tensor(np.setdiff1d(np.arange(args.nb_classes), seen_classes), dtype=torch.int64,
+                                   device=device)
+        class_bias_seen = torch.zeros(args.nb_classes, device=device)
+        class_bias_seen[not_mask] = float('-inf')
 
     # TODO: efficiency may be improved by encapsulating sampled data into Datasets class and using distributed sampler.
     for epoch in range(run_epochs):
 
-        sampled_data = []
-        sampled_label = []
-        num_sampled_pcls = args.batch_size * 5
-
         metric_logger = utils.MetricLogger(delimiter="  ")
         metric_logger.add_meter('Lr', utils.SmoothedValue(window_size=1, fmt='{value:.6f}'))
         metric_logger.add_meter('Loss', utils.SmoothedValue(window_size=1, fmt='{value:.4f}'))
 
-        if args.ca_storage_efficient_method in ['covariance', 'variance']:
-            for i in range(task_id + 1):
-                for c_id in class_mask[i]:
-                    mean = torch.tensor(cls_mean[c_id], dtype=torch.float64).to(device)
-                    cov = cls_cov[c_id].to(device)
-                    if args.ca_storage_efficient_method == 'variance':
-                        cov = torch.diag(cov)
-                    m = MultivariateNormal(mean.float(), cov.float())
-                    sampled_data_single = m.sample(sample_shape=(num_sampled_pcls,))
-                    sampled_data.append(sampled_data_single)
-
-                    sampled_label.extend([c_id] * num_sampled_pcls)
-
-                    if i == task_id:
-                        latest_data.append(sampled_data_single)
-                        latest_labels.extend([c_id] * num_sampled_pcls)
-
-        elif args.ca_storage_efficient_method == 'multi-centroid':
-            for i in range(task_id + 1):
-                for c_id in class_mask[i]:
-                    for cluster in range(len(cls_mean[c_id])):
-                        mean = cls_mean[c_id][cluster]
-                        var = cls_cov[c_id][cluster]
-                        if var.mean() == 0:
-                            continue
-                        m = MultivariateNormal(mean.float(), (torch.diag(var) + 1e-4 * torch.eye(mean.shape[0]).to(mean.device)).float())
-                        sampled_data_single = m.sample(sample_shape=(num_sampled_pcls,))
-                        sampled_data.append(sampled_data_single)
-                        sampled_label.extend([c_id] * num_sampled_pcls)
-                        
-                        if i == task_id:
-                            latest_data.append(sampled_data_single)
-                            latest_labels.extend([c_id] * num_sampled_pcls)
-        else:
-            raise NotImplementedError
-
-
-        sampled_data = torch.cat(sampled_data, dim=0).float().to(device)
-        sampled_label = torch.tensor(sampled_label).long().to(device)
+        # reparameterized sampling of all gaussians at once: mean + std * eps, or mean + L @ eps for 'covariance'
+        with torch.no_grad():
+            eps = torch.randn(means.shape[0], num_sampled_pcls, means.shape[-1], device=device)
+            if scale.dim() == 2:
+                sampled_data = means.unsqueeze(1) + eps * scale.unsqueeze(1)
+            else:
+                sampled_data = means.unsqueeze(1) + torch.einsum('cij,cnj->cni', scale, eps)
+            sampled_data = sampled_data.reshape(-1, means.shape[-1])
+            sampled_label = labels.repeat_interleave(num_sampled_pcls)
         print(sampled_data.shape)
-        
-        # latest_data = torch.cat(latest_data, dim=0).float().to(device)
-        # latest_labels = torch.cat(latest_labels).long().to(device)
-        old_data = sampled_data.detach().clone() #torch.cat((old_data, latest_data), dim=0).to(device)
-        old_labels = sampled_label.detach().clone() #torch.cat((old_labels, latest_labels), dim=0).to(device)
 
         inputs = sampled_data
         targets = sampled_label
 
-        sf_indexes = torch.randperm(inputs.size(0))
-        inputs = inputs[sf_indexes]
-        targets = targets[sf_indexes]
+        # shuffle through indices, only the current mini-batch is gathered instead of a permuted copy of all samples
+        sf_indexes = torch.randperm(inputs.size(0), device=device)
 
         for _iter in range(crct_num):
-            inp = inputs[_iter * num_sampled_pcls:(_iter + 1) * num_sampled_pcls]
-            tgt = targets[_iter * num_sampled_pcls:(_iter + 1) * num_sampled_pcls]
-            outputs = model(inp, fc_only=True)
-            logits = outputs['logits']
-
-            if args.train_mask and class_mask is not None:
-                mask = []
-                for id in range(task_id + 1):
-                    mask.extend(class_mask[id])
-                # print(mask)
-                not_mask = np.setdiff1d(np.arange(args.nb_classes), mask)
-                not_mask = torch.tensor(not_mask, dtype=torch.int64).to(device)
-                logits = logits.index_fill(dim=1, index=not_mask, value=float('-inf'))
+            idx = sf_indexes[_iter * num_sampled_pcls:(_iter + 1) * num_sampled_pcls]
+            inp = inputs.index_select(0, idx)
+            tgt = targets.index_select(0, idx)
+            with torch.autocast('cuda', dtype=torch.bfloat16, enabled=use_bf16):
+                outputs = model(inp, fc_only=True)
+            logits = outputs['logits'].float()
+
+            if class_bias_seen is not None:
+                logits = logits + class_bias_seen
 
             loss = criterion(logits, tgt)  # base criterion (CrossEntropyLoss)
-            acc1, acc5 = accuracy(logits, tgt, topk=(1, 5))
+            acc1, acc5 = topk_accuracy(logits, tgt)
 
-            if not math.isfinite(loss.item()):
+            # as in train_one_epoch, only sync on the loss every print_freq steps
+            if _iter % args.print_freq == 0 and not math.isfinite(loss.item()):
                 print("Loss is {}, stopping training".format(loss.item()))
                 sys.exit(1)
 
-            optimizer.zero_grad()
+            optimizer.zero_grad(set_to_none=True)
             loss.backward()
             optimizer.step()
-            torch.cuda.synchronize()
 
-            metric_logger.update(Loss=loss.item())
+            metric_logger.update(Loss=loss.detach())
             metric_logger.update(Lr=optimizer.param_groups[0]["lr"])
-            metric_logger.meters['Acc@1'].update(acc1.item(), n=inp.shape[0])
-            metric_logger.meters['Acc@5'].update(acc5.item(), n=inp.shape[0])
+            metric_logger.meters['Acc@1'].update(acc1, n=inp.shape[0])
+            metric_logger.meters['Acc@5'].update(acc5, n=inp.shape[0])
 
             # gather the stats from all processes
         metric_logger.synchronize_between_processes()
         print("Averaged stats:", metric_logger)
         scheduler.step()
 
-def orth_loss(features, targets, device, args):
-    if cls_mean:
-        # orth loss of this batch
+def aux_losses(features, targets, device, args):
+    # orth loss (robustness trick) + cluster loss of one training step
+    return orth_loss(features, targets, device, args) + cluster_loss(features, targets, device, args)
+
+def cls_mean_updated():
+    # invalidates the stacked prototypes cached for orth_loss, call after every change of cls_mean
+    global cls_mean_version
+    cls_mean_version += 1
+
+def _prototypes(device):
+    # all class means (every centroid in 'multi-centroid') stacked on the device, rebuilt only when cls_mean changed
+    if _proto_cache['version'] != cls_mean_version:
         sample_mean = []
         for k, v in cls_mean.items():
             if isinstance(v, list):
                 sample_mean.extend(v)
             else:
                 sample_mean.append(v)
-        sample_mean = torch.stack(sample_mean, dim=0).to(device, non_blocking=True)
-        M = torch.cat([sample_mean, features], dim=0)
+        _proto_cache['tensor'] = torch.stack(sample_mean, dim=0).to(device, torch.float32, non_blocking=True)
+        _proto_cache['version'] = cls_mean_version
+    return _proto_cache['tensor']
+
+def orth_loss(features, targets, device, args):
+    if cls_mean:
+        # orth loss of this batch
+        M = torch.cat([_prototypes(device), features], dim=0)
         sim = torch.matmul(M, M.t()) / 0.8
-        loss = torch.nn.functional.cross_entropy(sim, torch.range(0, sim.shape[0] - 1).long().to(device))
+        loss = torch.nn.functional.cross_entropy(sim, torch.arange(sim.shape[0], device=device))
         return args.reg * loss
     else:
         sim = torch.matmul(features, features.t()) / 0.8
-        loss = torch.nn.functional.cross_entropy(sim, torch.range(0, sim.shape[0] - 1).long().to(device))
+        loss = torch.nn.functional.cross_entropy(sim, torch.arange(sim.shape[0], device=device))
         return args.reg * loss
         # return 0.
         
-def supervised_contrastive_loss(features, labels, temperature=0.1, Gamma=None):
-    # Normalize features
-    features = F.normalize(features, p=2, dim=1)
-    
-    if Gamma != None:
-        n_sample = len(features)
-        weight_matrix = torch.zeros((n_sample, n_sample)).to(features.device)
-        labelZ = labels.long()
-        for i in range(n_sample):
-            for j in range(n_sample):
-                if weight_matrix[i][j] != 0:
-                    continue
-                weight_matrix[i][j] = Gamma[labelZ[i], labelZ[j]]
-                weight_matrix[j][i] = weight_matrix[i][j]
-            
+def supervised_contrastive_loss(features, labels, temperature=0.1, Gamma=None, cos_sim=None):
+    # no positive pairs without a repeated label
+    if labels.unique().numel() == labels.numel():
+        return 0
 
-        weight_matrix = weight_matrix.detach()
-    else:
-        n_sample = len(features)
-        weight_matrix = torch.ones((n_sample, n_sample)).detach().to(features.device)
-    
-    # Compute similarity matrix
-    sim_matrix = torch.matmul(features, features.t()) / temperature
-    sim_matrix = sim_matrix * weight_matrix
+    # cos_sim: cosine similarity matrix of features, if already computed by the caller
+    if cos_sim is None:
+        # Normalize features
+        features = F.normalize(features, p=2, dim=1)
+        cos_sim = torch.matmul(features, features.t())
     
-    # Mask to remove self-comparisons
-    mask = torch.eye(labels.size(0), dtype=torch.bool, device=features.device)
-    
-    # Create label mask for positive pairs
-    label_mask = labels.unsqueeze(1) == labels.unsqueeze(0)
-    
-    # Exclude self-comparisons
-    positive_mask = label_mask & ~mask
-    if positive_mask.sum() == 0:
-        return 0
+    # Compute similarity matrix, weighted by the class-pair entries of Gamma
+    sim_matrix = cos_sim / temperature
+    if Gamma is not None:
+        labelZ = labels.long()
+        weight_matrix = Gamma[labelZ][:, labelZ].detach()
+        sim_matrix = sim_matrix * weight_matrix
     
-    # Compute logits and apply log-softmax
-    logits = sim_matrix - torch.max(sim_matrix, dim=1, keepdim=True)[0]
-    log_prob = F.log_softmax(logits, dim=1)
+    # Create label mask for positive pairs, excluding self-comparisons in place
+    positive_mask = labels.unsqueeze(1) == labels.unsqueeze(0)
+    positive_mask.fill_diagonal_(False)
     
-    # Compute the supervised contrastive loss
-    loss = -log_prob[positive_mask].sum() / positive_mask.sum()
+    # Compute the supervised contrastive loss: sum over positives of sim - logsumexp(row), without
+    # materializing the N x N log_softmax
+    lse = torch.logsumexp(sim_matrix, dim=1)
+    loss = -(sim_matrix[positive_mask].sum() - (lse * positive_mask.sum(dim=1)).sum()) / positive_mask.count_nonzero()
     
     return loss
 
-def subsup_loss(features, labels, label_sets, temperature=0.1, args=None):
+def subsup_loss(features, labels, class_group_member, temperature=0.1, args=None, cos_sim=None):
+    # class_group_member: nb_classes x num_sets boolean membership of the classes in the label subsets
     total_loss = 0.0
-    num_sets = len(label_sets)
     
-    for label_subset in label_sets:
+    # Gamma only changes with WSDMatrix, without the OT trick all pairs weigh 1
+    Gamma = WSDGamma if args.OT_trick else None
+
+    num_sets = class_group_member.shape[1]
+    member = class_group_member[labels.long()]
+    for k in range(num_sets):
         # Select features and labels for the current subset
-        mask = torch.isin(labels, torch.tensor(label_subset, device=features.device))
+        mask = member[:, k]
         subset_features = features[mask]
         subset_labels = labels[mask]
-        
-        if args.OT_trick:
-            Gamma = 1 / np.exp(WSDMatrix / args.delta).to(features.device)
-        else:
-            Gamma = torch.ones((args.nb_classes, args.nb_classes)).to(features.device)
+        subset_cos_sim = cos_sim[mask][:, mask] if cos_sim is not None else None
         
         # Compute the supervised contrastive loss for the subset
         if len(subset_features) > 1:
-            loss = supervised_contrastive_loss(subset_features, subset_labels, temperature, Gamma)
+            loss = supervised_contrastive_loss(subset_features, subset_labels, temperature, Gamma, subset_cos_sim)
             total_loss += loss
 
     return total_loss / num_sets
@@ -830,107 +878,111 @@ def subsup_loss(features, labels, label_sets, temperature=0.1, args=None):
 def cluster_loss(features, targets, device, args):
     
     old_bs = args.batch_size * 5
-    sf_indexes = torch.randperm(old_data.size(0))
-    old_inputs = old_data[sf_indexes]
-    old_inputs =  old_inputs[:old_bs]
-    old_targets = old_labels[sf_indexes]
-    old_targets = old_targets[:old_bs]
+    n_old = old_data.size(0)
+    if n_old > old_bs:
+        # draw old_bs replay samples (with replacement) instead of permuting the whole buffer every step
+        sf_indexes = torch.randint(n_old, (old_bs,), device=old_data.device)
+        old_inputs = old_data.index_select(0, sf_indexes)
+        old_targets = old_labels.index_select(0, sf_indexes)
+    else:
+        old_inputs = old_data
+        old_targets = old_labels
     
     features = torch.cat((features, old_inputs), dim=0)
     targets = torch.cat((targets, old_targets), dim=0)
+
+    # normalize and compute the similarities once; the subset losses use blocks of the same matrix
+    features = F.normalize(features, p=2, dim=1)
+    cos_sim = torch.matmul(features, features.t())
     
-    sub_loss = subsup_loss(features,  targets, current_llist, args=args)
-    glob_loss =  supervised_contrastive_loss(features, targets)
+    sub_loss = subsup_loss(features,  targets, class_group_member, args=args, cos_sim=cos_sim)
+    glob_loss =  supervised_contrastive_loss(features, targets, cos_sim=cos_sim)
         
     return args.reg_glob * glob_loss + args.reg_sub * sub_loss
 
 
 ## For testing... 
 def mahalanobis_distance(x, mean, cov, args):
+    # mean: (C x) D, cov: (C x) D variances or (C x) D x D lower cholesky factor of the jittered covariance
+    # (see stack_class_statistics) -> distances of x (B x D) to every mean, (C x) B
     mean, cov = mean.cuda(), cov.cuda()
-    cov_inv = torch.inverse(cov + (1e-6)*torch.eye(cov.shape[0]).cuda() )
-    diff = x - mean
-    return torch.sqrt(torch.sum((diff @ cov_inv) * diff, dim=1))
+    diff = x.to(mean.dtype) - mean.unsqueeze(-2)
+    if cov.dim() == mean.dim():
+        return torch.sqrt(torch.sum(diff ** 2 / (cov.unsqueeze(-2) + 1e-6), dim=-1))
+    y = torch.linalg.solve_triangular(cov, diff.transpose(-1, -2), upper=False)
+    return torch.sqrt(torch.sum(y ** 2, dim=-2))
 
 def distance_to_gmm(x, means, covariances, args):
-    distances = torch.empty(0).cuda()
-    n = len(means)
-    for i, (mean, cov) in enumerate(zip(means, covariances)):
-        if True:
-            cov = torch.diag(cov) #+ 1e-4 * torch.eye(mean.shape[0]).to(mean.device).float()
-        distance = mahalanobis_distance(x, mean, cov,  args)
-        # print(distance.shape)
-        distances = torch.cat((distances, distance.unsqueeze(1)), dim=1)
-        
-    distances = distances.min(dim=1)[0]
+    # distance to the nearest of the K diagonal gaussians, all centroids in one batched call
+    if isinstance(means, list):
+        means, covariances = torch.stack(means), torch.stack(covariances)
+    distances = mahalanobis_distance(x, means, covariances, args)  # K x B
+
+    distances = distances.min(dim=0)[0]
 
     return distances
 
+def stack_class_statistics(cls_mean, cls_cov, device):
+    # dense device copies of the per-class statistics, built once per checkpoint for MHD_cls:
+    # class ids, means C x (K x) D, covs C x (K x) D (x D), K centroids in 'multi-centroid', and for full
+    # covariances their cholesky factors with the 1e-6 jitter (None otherwise), factorized here once
+    def _stack(v):
+        return torch.stack(v) if isinstance(v, list) else torch.as_tensor(v)
+    keys = list(cls_mean.keys())
+    means = torch.stack([_stack(cls_mean[c_id]).float() for c_id in keys]).to(device)
+    covs = torch.stack([_stack(cls_cov[c_id]).float() for c_id in keys]).to(device)
+    covs_chol = None
+    if covs.dim() == means.dim() + 1:
+        covs_chol = torch.linalg.cholesky(covs + 1e-6 * torch.eye(covs.shape[-1], device=covs.device))
+    return keys, means, covs, covs_chol
+
 def MHD_cls(features, device, args):
-    n = len(args.clsMean)
-    keys = args.clsMean.keys()
-    distance = torch.ones((features.shape[0], args.nb_classes))*1e12
+    keys = args.clsIds
+    distance = torch.full((features.shape[0], args.nb_classes), 1e12, device=device)
     if args.ca_storage_efficient_method in ['covariance', 'variance']:
-        for c_id in keys:
-            mean = torch.tensor(args.clsMean[c_id], dtype=torch.float64).to(device)
-            cov = args.clsCov[c_id].to(device)
-            if args.ca_storage_efficient_method == 'variance':
-                cov = torch.diag(cov)
-            dis = mahalanobis_distance(features, mean, cov, args)
-            distance[:, c_id] = dis.reshape(distance[:, c_id].shape)
+        # all classes in one batched call, 'variance' keeps its diagonal as a vector
+        cov = args.clsCovChol_gpu if args.clsCovChol_gpu is not None else args.clsCov_gpu
+        dis = mahalanobis_distance(features, args.clsMean_gpu, cov, args)
+        distance[:, keys] = dis.t().to(distance.dtype)
 
     elif args.ca_storage_efficient_method == 'multi-centroid':
-        for c_id in keys:
-            means = args.clsMean[c_id]
-            covs = args.clsCov[c_id]
-            dis = distance_to_gmm(features, means, covs, args)
-            distance[:, c_id] = dis.reshape(distance[:, c_id].shape)
+        for i, c_id in enumerate(keys):
+            dis = distance_to_gmm(features, args.clsMean_gpu[i], args.clsCov_gpu[i], args)
+            distance[:, c_id] = dis.reshape(distance[:, c_id].shape).to(distance.dtype)
             
     else:
             raise NotImplementedError
         
     return distance
 
-def create_number_to_sublist_map(list_of_lists):
-    number_map = {}
-    for index, sublist in enumerate(list_of_lists):
-        for number in sublist:
-            number_map[number] = index
-    
-    mapG = number_map
+def stack_group_statistics(G, W_MHDs, nb_classes, device):
+    # per checkpoint for process_MHD: class indices of every group, the classes outside all groups
+    # and the columns of W_MHDs of every group (nb_classes x |g|, contiguous)
+    G_tensors = [torch.as_tensor(g_list, dtype=torch.int64, device=device) for g_list in G]
+    A_filtered = torch.as_tensor(np.setdiff1d(np.arange(nb_classes), sum(G, [])), dtype=torch.int64, device=device)
+    W_MHDs_g = [W_MHDs[:, g_list].contiguous() for g_list in G_tensors]
+    return G_tensors, A_filtered, W_MHDs_g
 
 def process_MHD(distance, logits, args):
-    W_MHDs = args.W_Matric
-    n = len(distance)
-    processed_score = torch.zeros(distance.shape).cuda()
+    device = logits.device
+    distance = distance.to(device)
     logits = logits.clone().detach()
-    A_filtered = range(args.nb_classes)
-    B = []
-    for g in args.G:
-        B += g
-    for i in range(n):
-        dis_i = distance[i].unsqueeze(1).cuda()
-        logit_i = logits[i].unsqueeze(1)
-        g_total = 0
-        g_nearest = 0
-        d_logits_max = -1e5
-        for g_list in args.G:
-            dis_ig = dis_i[torch.LongTensor(g_list)]
-            logit_ig = logit_i[torch.LongTensor(g_list)]
-            nearest_sim, nearest_label = torch.max(logit_ig, dim=0) #torch.max(dis_i[torch.LongTensor(g_list)])
-            nearest_label = g_list[nearest_label]
-            map_w = W_MHDs[nearest_label][torch.LongTensor(g_list)].unsqueeze(0)
-            d = map_w.mm(dis_ig)
-            E_g = torch.exp(args.eta_0*nearest_sim - args.eta*d)
-            g_total += E_g
-            logit_i[torch.LongTensor(g_list)] = logit_i[torch.LongTensor(g_list)]*E_g
-
-
-        logit_i = logit_i/ g_total
-        A_filtered = [item for item in A_filtered if item not in B]
-        logit_i[A_filtered] = logit_i[A_filtered] + float('-inf')
-
-        processed_score[i] = logit_i.reshape(processed_score[i].shape)
+
+    # all samples of the batch at once, one pass per group
+    g_total = 0
+    for g_list, W_MHDs_g in zip(args.G_tensors, args.W_MHDs_g):
+        dis_g = distance[:, g_list]
+        logit_g = logits[:, g_list]
+        nearest_sim, nearest_idx = torch.max(logit_g, dim=1)
+        nearest_label = g_list[nearest_idx]
+        map_w = W_MHDs_g[nearest_label]
+        d = (map_w * dis_g).sum(dim=1)
+        E_g = torch.exp(args.eta_0 * nearest_sim - args.eta * d)
+        g_total += E_g
+        logits[:, g_list] = logit_g * E_g.unsqueeze(1)
+
+    processed_score = logits / g_total.unsqueeze(1)
+    processed_score[:, args.A_filtered] = float('-inf')
     return processed_score
 
 
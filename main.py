@@ -22,6 +22,10 @@ import warnings
 
 warnings.filterwarnings('ignore', 'Argument interpolation should be of type InterpolationMode instead of int')
 
+# expandable segments keep the caching allocator from fragmenting as per-task tensors grow (PyTorch >= 2.1)
+if tuple(int(v) for v in torch.__version__.split('.')[:2]) >= (2, 1):
+    os.environ.setdefault('PYTORCH_CUDA_ALLOC_CONF', 'expandable_segments:True')
+
 
 def get_args():
     parser = argparse.ArgumentParser('DualPrompt training and evaluation configs')
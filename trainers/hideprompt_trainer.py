@@ -4,7 +4,8 @@ from timm.scheduler import create_scheduler
 from timm.optim import create_optimizer
 import time, datetime, os, sys, random, numpy as np
 from datasets import build_continual_dataloader
-from engines.hide_promtp_wtp_and_tap_engine import train_and_evaluate, evaluate_till_now
+from engines.hide_promtp_wtp_and_tap_engine import train_and_evaluate, evaluate_till_now, stack_class_statistics, \
+    stack_group_statistics
 import vits.hide_prompt_vision_transformer as hide_prompt_vision_transformer
 
 
@@ -82,9 +83,13 @@ def train(args):
                     evalTrick = True
                     args.WSDMatrix_old = args.WSDMatrix_old * (torch.ones(args.WSDMatrix_old.shape) - torch.eye(args.WSDMatrix_old.shape[0])).cuda() # standardize trick
                     args.W_Matric =  1 / torch.exp(args.WSDMatrix_old / args.delta2).to(device)
+                    args.G_tensors, args.A_filtered, args.W_MHDs_g = stack_group_statistics(args.G, args.W_Matric,
+                                                                                            args.nb_classes, device)
                 
                 args.clsMean = checkpoint['cls_mean']
                 args.clsCov = checkpoint['cls_cov']
+                args.clsIds, args.clsMean_gpu, args.clsCov_gpu, args.clsCovChol_gpu = stack_class_statistics(
+                    args.clsMean, args.clsCov, device)
             else:
                 print('No checkpoint found at:', checkpoint_path)
                 return
@@ -7,7 +7,8 @@ import io
 import os
 import time
 import math
-from collections import defaultdict, deque
+import threading
+from collections import defaultdict, deque, OrderedDict
 import datetime
 
 import torch
@@ -16,6 +17,8 @@ import torch.distributed as dist
 class SmoothedValue(object):
     """Track a series of values and provide access to smoothed values over a
     window or the global series average.
+
+    Values can be device tensors; they are only copied to the host when read.
     """
 
     def __init__(self, window_size=20, fmt=None):
@@ -27,6 +30,8 @@ class SmoothedValue(object):
         self.fmt = fmt
 
     def update(self, value, n=1):
+        if isinstance(value, torch.Tensor):
+            value = value.detach()
         self.deque.append(value)
         self.count += n
         self.total += value * n
@@ -37,34 +42,37 @@ class SmoothedValue(object):
         """
         if not is_dist_avail_and_initialized():
             return
-        t = torch.tensor([self.count, self.total], dtype=torch.float64, device='cuda')
+        t = torch.tensor([self.count, float(self.total)], dtype=torch.float64, device='cuda')
         dist.barrier()
         dist.all_reduce(t)
         t = t.tolist()
         self.count = int(t[0])
         self.total = t[1]
 
+    def _values(self):
+        return [float(v) for v in self.deque]
+
     @property
     def median(self):
-        d = torch.tensor(list(self.deque))
+        d = torch.tensor(self._values())
         return d.median().item()
 
     @property
     def avg(self):
-        d = torch.tensor(list(self.deque), dtype=torch.float32)
+        d = torch.tensor(self._values(), dtype=torch.float32)
         return d.mean().item()
 
     @property
     def global_avg(self):
-        return self.total / self.count
+        return float(self.total) / self.count
 
     @property
     def max(self):
-        return max(self.deque)
+        return max(self._values())
 
     @property
     def value(self):
-        return self.deque[-1]
+        return float(self.deque[-1])
 
     def __str__(self):
         return self.fmt.format(
@@ -75,6 +83,48 @@ class SmoothedValue(object):
             value=self.value)
 
 
+class CUDAPrefetcher(object):
+    """Iterate a DataLoader with the host-to-device copy of the next batch
+    issued on a side stream, so it overlaps with the compute on the current
+    batch. The DataLoader should use pin_memory for the copy to be async.
+    """
+
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = torch.device(device)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _preload(self, it, stream):
+        try:
+            batch = next(it)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(stream):
+            batch = [t.to(self.device, non_blocking=True) for t in batch]
+        return batch, stream.record_event()
+
+    def __iter__(self):
+        if self.device.type != 'cuda':
+            for batch in self.loader:
+                yield [t.to(self.device) for t in batch]
+            return
+
+        stream = torch.cuda.Stream(device=self.device)
+        it = iter(self.loader)
+        next_batch = self._preload(it, stream)
+        while next_batch is not None:
+            batch, event = next_batch
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_event(event)
+            for t in batch:
+                # do not let the allocator hand the memory back to the copy stream while in use
+                t.record_stream(current_stream)
+            next_batch = self._preload(it, stream)
+            yield batch
+
+
 class MetricLogger(object):
     def __init__(self, delimiter="\t"):
         self.meters = defaultdict(SmoothedValue)
@@ -83,8 +133,8 @@ class MetricLogger(object):
     def update(self, **kwargs):
         for k, v in kwargs.items():
             if isinstance(v, torch.Tensor):
-                v = v.item()
-            assert isinstance(v, (float, int))
+                v = v.detach()
+            assert isinstance(v, (torch.Tensor, float, int))
             self.meters[k].update(v)
 
     def __getattr__(self, attr):
@@ -211,6 +261,59 @@ def save_on_master(*args, **kwargs):
         torch.save(*args, **kwargs)
 
 
+_async_save_thread = None
+_async_save_error = None
+
+
+def _copy_to_cpu(obj):
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, OrderedDict):
+        copied = OrderedDict((k, _copy_to_cpu(v)) for k, v in obj.items())
+        if hasattr(obj, '_metadata'):
+            copied._metadata = obj._metadata
+        return copied
+    if isinstance(obj, dict):
+        return {k: _copy_to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_copy_to_cpu(v) for v in obj)
+    return obj
+
+
+def save_on_master_async(obj, path):
+    """
+    Like save_on_master, but torch.save runs in a background thread. Tensors
+    are snapshotted to the CPU first, so training can keep updating them.
+    """
+    global _async_save_thread
+    if not is_main_process():
+        return
+    wait_for_async_save()
+    _async_save_thread = threading.Thread(target=_save_in_background, args=(_copy_to_cpu(obj), path))
+    _async_save_thread.start()
+
+
+def _save_in_background(obj, path):
+    global _async_save_error
+    try:
+        torch.save(obj, path)
+    except BaseException as e:
+        _async_save_error = e
+
+
+def wait_for_async_save():
+    """
+    Waits for the pending background save and re-raises its exception, if any.
+    """
+    global _async_save_thread, _async_save_error
+    if _async_save_thread is not None:
+        _async_save_thread.join()
+        _async_save_thread = None
+    if _async_save_error is not None:
+        error, _async_save_error = _async_save_error, None
+        raise error
+
+
 def init_distributed_mode(args):
     if 'RANK' in os.environ and 'WORLD_SIZE' in os.environ:
         args.rank = int(os.environ["RANK"])